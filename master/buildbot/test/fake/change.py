@@ -17,9 +17,13 @@ from __future__ import annotations
 
 from typing import Any
 
+from buildbot import util
 from buildbot.process.properties import Properties
 from buildbot.test.fake.state import State
 
+# shared by every Change constructed without properties; treat as read-only
+_EMPTY_PROPERTIES = Properties()
+
 
 class Change(State):
     project = ''
@@ -32,6 +36,15 @@ class Change(State):
     def __init__(self, **kw: Any) -> None:
         super().__init__(**kw)
         # change.properties is a IProperties
+        if self.properties is Change.properties and not self.properties:
+            self.properties = _EMPTY_PROPERTIES
+            return
         props = Properties()
-        props.update(self.properties, "test")  # type: ignore[arg-type]
+        if isinstance(self.properties, dict):
+            # unlike setProperty, values are not checked to be JSON-serializable
+            props.properties = {
+                util.bytes2unicode(k): (v, "test") for k, v in self.properties.items()
+            }
+        elif self.properties:
+            props.update(self.properties, "test")  # type: ignore[arg-type]
         self.properties = props
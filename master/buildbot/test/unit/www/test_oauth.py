@@ -15,6 +15,8 @@
 
 from __future__ import annotations
 
+import contextlib
+import functools
 import json
 import os
 import warnings
@@ -25,6 +27,7 @@ from unittest import mock
 
 import twisted
 import urllib3
+from parameterized import parameterized
 from twisted.internet import defer
 from twisted.internet import reactor
 from twisted.internet.threads import (
@@ -42,8 +45,11 @@ from buildbot.test.reactor import TestReactorMixin
 from buildbot.test.util import www
 from buildbot.test.util.config import ConfigErrorsMixin
 from buildbot.test.util.site import SiteWithClose
+from buildbot.util.twisted import async_to_deferred
 
 if TYPE_CHECKING:
+    from collections.abc import Iterator
+
     from buildbot.util.twisted import InlineCallbacksType
 
 try:
@@ -58,255 +64,244 @@ else:
     oauth2 = None  # type: ignore[assignment]
 
 
+REDIRECT_STATE = "&state=redirect%3Dhttp%253A%252F%252Fredir"
+
+GOOGLE_LOGIN_URL = (
+    "https://accounts.google.com/o/oauth2/auth?client_id=ggclientID&"
+    "redirect_uri=h%3A%2Fa%2Fb%2Fauth%2Flogin&response_type=code&"
+    "scope=https%3A%2F%2Fwww.googleapis.com%2Fauth%2Fuserinfo.email+"
+    "https%3A%2F%2Fwww.googleapis.com%2Fauth%2Fuserinfo.profile"
+)
+GITHUB_LOGIN_URL = (
+    "https://github.com/login/oauth/authorize?client_id=ghclientID&"
+    "redirect_uri=h%3A%2Fa%2Fb%2Fauth%2Flogin&response_type=code&"
+    "scope=user%3Aemail+read%3Aorg"
+)
+GITHUB_SECRET_LOGIN_URL = (
+    "https://github.com/login/oauth/authorize?client_id=secretClientId&"
+    "redirect_uri=h%3A%2Fa%2Fb%2Fauth%2Flogin&response_type=code&"
+    "scope=user%3Aemail+read%3Aorg"
+)
+GITHUB_ENTERPRISE_LOGIN_URL = (
+    "https://git.corp.fakecorp.com/login/oauth/authorize?client_id=ghclientID&"
+    "redirect_uri=h%3A%2Fa%2Fb%2Fauth%2Flogin&response_type=code&"
+    "scope=user%3Aemail+read%3Aorg"
+)
+GITLAB_LOGIN_URL = (
+    "https://gitlab.test/oauth/authorize"
+    "?client_id=glclientID&"
+    "redirect_uri=h%3A%2Fa%2Fb%2Fauth%2Flogin&"
+    "response_type=code"
+)
+BITBUCKET_LOGIN_URL = (
+    "https://bitbucket.org/site/oauth2/authorize?"
+    "client_id=bbclientID&"
+    "redirect_uri=h%3A%2Fa%2Fb%2Fauth%2Flogin&"
+    "response_type=code"
+)
+KEYCLOAK_LOGIN_URL = (
+    "instance_uri/realms/realm/protocol/openid-connect/auth?client_id=client_id&"
+    "redirect_uri=http%3A%2F%2Flocalhost%3A5000%2Fauth%2Flogin&response_type=code&"
+    "scope=openid"
+)
+
+GITHUB_EXPECTED_HEADERS = {
+    'Authorization': 'token TOK3N',
+    'User-Agent': f'buildbot/{buildbot.version}',
+}
+GITHUB_V3_RESPONSES: dict[str, Any] = {
+    '/user': {"login": 'bar', "name": 'foo bar', "email": 'buzz@bar'},
+    '/user/emails': [
+        {'email': 'buzz@bar', 'verified': True, 'primary': False},
+        {'email': 'bar@foo', 'verified': True, 'primary': True},
+    ],
+    '/user/orgs': [
+        {"login": 'hello'},
+        {"login": 'grp'},
+    ],
+}
+
+GITHUB_V4_TEAMS_RESPONSES: list[dict[str, Any]] = [
+    {
+        'data': {
+            'viewer': {
+                'organizations': {
+                    'edges': [{'node': {'login': 'hello'}}, {'node': {'login': 'grp'}}]
+                },
+                'login': 'bar',
+                'email': 'bar@foo',
+                'name': 'foo bar',
+            }
+        }
+    },
+    {
+        'data': {
+            'hello': {
+                'teams': {
+                    'edges': [
+                        {'node': {'name': 'developers', 'slug': 'develpers'}},
+                        {'node': {'name': 'contributors', 'slug': 'contributors'}},
+                    ]
+                }
+            },
+            'grp': {
+                'teams': {
+                    'edges': [
+                        {'node': {'name': 'developers', 'slug': 'develpers'}},
+                        {'node': {'name': 'contributors', 'slug': 'contributors'}},
+                        {'node': {'name': 'committers', 'slug': 'committers'}},
+                        {
+                            'node': {
+                                'name': 'Team with spaces and caps',
+                                'slug': 'team-with-spaces-and-caps',
+                            }
+                        },
+                    ]
+                }
+            },
+        }
+    },
+]
+
+
 class FakeResponse:
     def __init__(self, _json: Any) -> None:
+        self._json = _json
         self.json = lambda: _json
-        self.content = json.dumps(_json)
+
+    @property
+    def content(self) -> str:
+        return json.dumps(self._json)
 
     def raise_for_status(self) -> None:
         pass
 
 
-class OAuth2Auth(TestReactorMixin, www.WwwTestMixin, ConfigErrorsMixin, unittest.TestCase):
+TOKEN_RESPONSE = FakeResponse({"access_token": 'TOK3N'})
+
+
+class OAuth2TestMixin(TestReactorMixin, www.WwwTestMixin, ConfigErrorsMixin):
     def setUp(self) -> None:
         self.setup_test_reactor()
         if requests is None:
             raise unittest.SkipTest("Need to install requests to test oauth2")
 
-        self.patch(requests, 'request', mock.Mock(spec=requests.request))
-        self.patch(requests, 'post', mock.Mock(spec=requests.post))
-        self.patch(requests, 'get', mock.Mock(spec=requests.get))
-
-    @defer.inlineCallbacks
-    def setup_google_auth(self) -> InlineCallbacksType[Any]:
-        auth = oauth2.GoogleAuth("ggclientID", "clientSECRET")
-        master = yield self.make_master(url='h:/a/b/', auth=auth)
-        auth.reconfigAuth(master, master.config)
-        return auth
-
-    @defer.inlineCallbacks
-    def setup_github_auth(self) -> InlineCallbacksType[Any]:
-        auth = oauth2.GitHubAuth("ghclientID", "clientSECRET")
-        master = yield self.make_master(url='h:/a/b/', auth=auth)
-        auth.reconfigAuth(master, master.config)
-        return auth
-
-    @defer.inlineCallbacks
-    def setup_github_auth_v4(self) -> InlineCallbacksType[Any]:
-        auth = oauth2.GitHubAuth("ghclientID", "clientSECRET", apiVersion=4)
-        master = yield self.make_master(url='h:/a/b/', auth=auth)
-        auth.reconfigAuth(master, master.config)
-        return auth
-
-    @defer.inlineCallbacks
-    def setup_github_auth_v4_secret(self) -> InlineCallbacksType[Any]:
-        auth = oauth2.GitHubAuth(Secret("client-id"), Secret("client-secret"), apiVersion=4)  # type: ignore[arg-type]
-        master = yield self.make_master(url='h:/a/b/', auth=auth)
-        fake_storage_service = FakeSecretStorage()
-        fake_storage_service.reconfigService(
-            secretdict={"client-id": "secretClientId", "client-secret": "secretClientSecret"}
-        )
-        secret_service = SecretManager()
-        secret_service.services = [fake_storage_service]
-        yield secret_service.setServiceParent(master)
-        auth.reconfigAuth(master, master.config)
-        return auth
-
-    @defer.inlineCallbacks
-    def setup_github_auth_v4_teams(self) -> InlineCallbacksType[Any]:
-        auth = oauth2.GitHubAuth(
-            "ghclientID", "clientSECRET", apiVersion=4, getTeamsMembership=True
-        )
-        master = yield self.make_master(url='h:/a/b/', auth=auth)
-        auth.reconfigAuth(master, master.config)
-        return auth
+        self.patch(requests, 'request', mock.Mock())
+        # verifyCode() must not fetch anything through requests directly
+        self.patch(requests, 'get', mock.Mock(side_effect=[]))
+        # and must exchange the code for a token exactly once
+        self.patch(requests, 'post', mock.Mock(side_effect=[TOKEN_RESPONSE]))
 
     @defer.inlineCallbacks
-    def setup_github_auth_enterprise(self) -> InlineCallbacksType[Any]:
-        auth = oauth2.GitHubAuth(
-            "ghclientID", "clientSECRET", serverURL="https://git.corp.fakecorp.com"
-        )
-        master = yield self.make_master(url='h:/a/b/', auth=auth)
+    def setup_auth(self, auth: Any, url: str = 'h:/a/b/') -> InlineCallbacksType[Any]:
+        master = yield self.make_master(url=url, auth=auth)
         auth.reconfigAuth(master, master.config)
         return auth
 
-    @defer.inlineCallbacks
-    def setup_github_auth_enterprise_v4(self) -> InlineCallbacksType[Any]:
-        auth = oauth2.GitHubAuth(
-            "ghclientID",
-            "clientSECRET",
-            apiVersion=4,
-            getTeamsMembership=True,
-            serverURL="https://git.corp.fakecorp.com",
-        )
-        master = yield self.make_master(url='h:/a/b/', auth=auth)
-        auth.reconfigAuth(master, master.config)
-        return auth
 
-    @defer.inlineCallbacks
-    def setup_gitlab_auth(self) -> InlineCallbacksType[Any]:
-        auth = oauth2.GitLabAuth("https://gitlab.test/", "glclientID", "clientSECRET")
-        master = yield self.make_master(url='h:/a/b/', auth=auth)
-        auth.reconfigAuth(master, master.config)
-        return auth
+class OAuth2Auth(OAuth2TestMixin, unittest.TestCase):
+    def setup_google_auth(self) -> defer.Deferred[Any]:
+        return self.setup_auth(oauth2.GoogleAuth("ggclientID", "clientSECRET"))
 
     @defer.inlineCallbacks
-    def setup_bitbucket_auth(self) -> InlineCallbacksType[Any]:
-        auth = oauth2.BitbucketAuth("bbclientID", "clientSECRET")
-        master = yield self.make_master(url='h:/a/b/', auth=auth)
-        auth.reconfigAuth(master, master.config)
+    def setup_github_auth(self, secret: bool = False, **kwargs: Any) -> InlineCallbacksType[Any]:
+        if secret:
+            auth = oauth2.GitHubAuth(Secret("client-id"), Secret("client-secret"), **kwargs)  # type: ignore[arg-type]
+        else:
+            auth = oauth2.GitHubAuth("ghclientID", "clientSECRET", **kwargs)
+        yield self.setup_auth(auth)
+        if secret:
+            fake_storage_service = FakeSecretStorage()
+            fake_storage_service.reconfigService(
+                secretdict={"client-id": "secretClientId", "client-secret": "secretClientSecret"}
+            )
+            secret_service = SecretManager()
+            secret_service.services = [fake_storage_service]
+            yield secret_service.setServiceParent(self.master)
         return auth
 
-    @defer.inlineCallbacks
-    def test_getGoogleLoginURL(self) -> InlineCallbacksType[None]:
-        auth = yield self.setup_google_auth()
-        res = yield auth.getLoginURL('http://redir')
-        exp = (
-            "https://accounts.google.com/o/oauth2/auth?client_id=ggclientID&"
-            "redirect_uri=h%3A%2Fa%2Fb%2Fauth%2Flogin&response_type=code&"
-            "scope=https%3A%2F%2Fwww.googleapis.com%2Fauth%2Fuserinfo.email+"
-            "https%3A%2F%2Fwww.googleapis.com%2Fauth%2Fuserinfo.profile&"
-            "state=redirect%3Dhttp%253A%252F%252Fredir"
-        )
-        self.assertEqual(res, exp)
-        res = yield auth.getLoginURL(None)
-        exp = (
-            "https://accounts.google.com/o/oauth2/auth?client_id=ggclientID&"
-            "redirect_uri=h%3A%2Fa%2Fb%2Fauth%2Flogin&response_type=code&"
-            "scope=https%3A%2F%2Fwww.googleapis.com%2Fauth%2Fuserinfo.email+"
-            "https%3A%2F%2Fwww.googleapis.com%2Fauth%2Fuserinfo.profile"
-        )
-
-        self.assertEqual(res, exp)
-
-    @defer.inlineCallbacks
-    def test_getGithubLoginURL(self) -> InlineCallbacksType[None]:
-        auth = yield self.setup_github_auth()
-        res = yield auth.getLoginURL('http://redir')
-        exp = (
-            "https://github.com/login/oauth/authorize?client_id=ghclientID&"
-            "redirect_uri=h%3A%2Fa%2Fb%2Fauth%2Flogin&response_type=code&"
-            "scope=user%3Aemail+read%3Aorg&"
-            "state=redirect%3Dhttp%253A%252F%252Fredir"
-        )
-        self.assertEqual(res, exp)
-        res = yield auth.getLoginURL(None)
-        exp = (
-            "https://github.com/login/oauth/authorize?client_id=ghclientID&"
-            "redirect_uri=h%3A%2Fa%2Fb%2Fauth%2Flogin&response_type=code&"
-            "scope=user%3Aemail+read%3Aorg"
-        )
-        self.assertEqual(res, exp)
-
-    @defer.inlineCallbacks
-    def test_getGithubLoginURL_with_secret(self) -> InlineCallbacksType[None]:
-        auth = yield self.setup_github_auth_v4_secret()
-        res = yield auth.getLoginURL('http://redir')
-        exp = (
-            "https://github.com/login/oauth/authorize?client_id=secretClientId&"
-            "redirect_uri=h%3A%2Fa%2Fb%2Fauth%2Flogin&response_type=code&"
-            "scope=user%3Aemail+read%3Aorg&"
-            "state=redirect%3Dhttp%253A%252F%252Fredir"
-        )
-        self.assertEqual(res, exp)
-        res = yield auth.getLoginURL(None)
-        exp = (
-            "https://github.com/login/oauth/authorize?client_id=secretClientId&"
-            "redirect_uri=h%3A%2Fa%2Fb%2Fauth%2Flogin&response_type=code&"
-            "scope=user%3Aemail+read%3Aorg"
-        )
-        self.assertEqual(res, exp)
-
-    @defer.inlineCallbacks
-    def test_getGithubELoginURL(self) -> InlineCallbacksType[None]:
-        auth = yield self.setup_github_auth_enterprise()
-
-        res = yield auth.getLoginURL('http://redir')
-        exp = (
-            "https://git.corp.fakecorp.com/login/oauth/authorize?client_id=ghclientID&"
-            "redirect_uri=h%3A%2Fa%2Fb%2Fauth%2Flogin&response_type=code&"
-            "scope=user%3Aemail+read%3Aorg&"
-            "state=redirect%3Dhttp%253A%252F%252Fredir"
-        )
-        self.assertEqual(res, exp)
-        res = yield auth.getLoginURL(None)
-        exp = (
-            "https://git.corp.fakecorp.com/login/oauth/authorize?client_id=ghclientID&"
-            "redirect_uri=h%3A%2Fa%2Fb%2Fauth%2Flogin&response_type=code&"
-            "scope=user%3Aemail+read%3Aorg"
-        )
-        self.assertEqual(res, exp)
-
-    @defer.inlineCallbacks
-    def test_getGithubLoginURL_v4(self) -> InlineCallbacksType[None]:
-        auth = yield self.setup_github_auth_enterprise_v4()
-
-        res = yield auth.getLoginURL('http://redir')
-        exp = (
-            "https://git.corp.fakecorp.com/login/oauth/authorize?client_id=ghclientID&"
-            "redirect_uri=h%3A%2Fa%2Fb%2Fauth%2Flogin&response_type=code&"
-            "scope=user%3Aemail+read%3Aorg&"
-            "state=redirect%3Dhttp%253A%252F%252Fredir"
-        )
-        self.assertEqual(res, exp)
-        res = yield auth.getLoginURL(None)
-        exp = (
-            "https://git.corp.fakecorp.com/login/oauth/authorize?client_id=ghclientID&"
-            "redirect_uri=h%3A%2Fa%2Fb%2Fauth%2Flogin&response_type=code&"
-            "scope=user%3Aemail+read%3Aorg"
-        )
-        self.assertEqual(res, exp)
-
-    @defer.inlineCallbacks
-    def test_getGitLabLoginURL(self) -> InlineCallbacksType[None]:
-        auth = yield self.setup_gitlab_auth()
-
-        res = yield auth.getLoginURL('http://redir')
-        exp = (
-            "https://gitlab.test/oauth/authorize"
-            "?client_id=glclientID&"
-            "redirect_uri=h%3A%2Fa%2Fb%2Fauth%2Flogin&"
-            "response_type=code&"
-            "state=redirect%3Dhttp%253A%252F%252Fredir"
-        )
-        self.assertEqual(res, exp)
-        res = yield auth.getLoginURL(None)
-        exp = (
-            "https://gitlab.test/oauth/authorize"
-            "?client_id=glclientID&"
-            "redirect_uri=h%3A%2Fa%2Fb%2Fauth%2Flogin&"
-            "response_type=code"
-        )
-        self.assertEqual(res, exp)
-
-    @defer.inlineCallbacks
-    def test_getBitbucketLoginURL(self) -> InlineCallbacksType[None]:
-        auth = yield self.setup_bitbucket_auth()
-
-        res = yield auth.getLoginURL('http://redir')
-        exp = (
-            "https://bitbucket.org/site/oauth2/authorize?"
-            "client_id=bbclientID&"
-            "redirect_uri=h%3A%2Fa%2Fb%2Fauth%2Flogin&"
-            "response_type=code&"
-            "state=redirect%3Dhttp%253A%252F%252Fredir"
-        )
-        self.assertEqual(res, exp)
-        res = yield auth.getLoginURL(None)
-        exp = (
-            "https://bitbucket.org/site/oauth2/authorize?"
-            "client_id=bbclientID&"
-            "redirect_uri=h%3A%2Fa%2Fb%2Fauth%2Flogin&"
-            "response_type=code"
-        )
-        self.assertEqual(res, exp)
+    def setup_gitlab_auth(self) -> defer.Deferred[Any]:
+        return self.setup_auth(
+            oauth2.GitLabAuth("https://gitlab.test/", "glclientID", "clientSECRET")
+        )
+
+    def setup_bitbucket_auth(self) -> defer.Deferred[Any]:
+        return self.setup_auth(oauth2.BitbucketAuth("bbclientID", "clientSECRET"))
+
+    @async_to_deferred
+    async def test_getGoogleLoginURL(self) -> None:
+        auth = await self.setup_google_auth()
+        res = await auth.getLoginURL('http://redir')
+        self.assertEqual(res, GOOGLE_LOGIN_URL + REDIRECT_STATE)
+        res = await auth.getLoginURL(None)
+        self.assertEqual(res, GOOGLE_LOGIN_URL)
+
+    @async_to_deferred
+    async def test_buildGoogleLoginURL(self) -> None:
+        auth = await self.setup_google_auth()
+        res = auth._buildLoginURL(auth.clientId, b'http://redir')
+        self.assertEqual(res, GOOGLE_LOGIN_URL + REDIRECT_STATE)
+        res = auth._buildLoginURL(auth.clientId, None)
+        self.assertEqual(res, GOOGLE_LOGIN_URL)
+
+    @async_to_deferred
+    async def test_buildGithubLoginURL(self) -> None:
+        auth = await self.setup_github_auth()
+        res = auth._buildLoginURL(auth.clientId, b'http://redir')
+        self.assertEqual(res, GITHUB_LOGIN_URL + REDIRECT_STATE)
+        res = auth._buildLoginURL(auth.clientId, None)
+        self.assertEqual(res, GITHUB_LOGIN_URL)
+
+    @async_to_deferred
+    async def test_getGithubLoginURL_with_secret(self) -> None:
+        auth = await self.setup_github_auth(secret=True, apiVersion=4)
+        res = await auth.getLoginURL('http://redir')
+        self.assertEqual(res, GITHUB_SECRET_LOGIN_URL + REDIRECT_STATE)
+        res = await auth.getLoginURL(None)
+        self.assertEqual(res, GITHUB_SECRET_LOGIN_URL)
+
+    @async_to_deferred
+    async def test_buildGithubELoginURL(self) -> None:
+        auth = await self.setup_github_auth(serverURL="https://git.corp.fakecorp.com")
+
+        res = auth._buildLoginURL(auth.clientId, b'http://redir')
+        self.assertEqual(res, GITHUB_ENTERPRISE_LOGIN_URL + REDIRECT_STATE)
+        res = auth._buildLoginURL(auth.clientId, None)
+        self.assertEqual(res, GITHUB_ENTERPRISE_LOGIN_URL)
+
+    @async_to_deferred
+    async def test_buildGithubLoginURL_v4(self) -> None:
+        auth = await self.setup_github_auth(
+            apiVersion=4, getTeamsMembership=True, serverURL="https://git.corp.fakecorp.com"
+        )
+
+        res = auth._buildLoginURL(auth.clientId, b'http://redir')
+        self.assertEqual(res, GITHUB_ENTERPRISE_LOGIN_URL + REDIRECT_STATE)
+        res = auth._buildLoginURL(auth.clientId, None)
+        self.assertEqual(res, GITHUB_ENTERPRISE_LOGIN_URL)
+
+    @async_to_deferred
+    async def test_buildGitLabLoginURL(self) -> None:
+        auth = await self.setup_gitlab_auth()
+
+        res = auth._buildLoginURL(auth.clientId, b'http://redir')
+        self.assertEqual(res, GITLAB_LOGIN_URL + REDIRECT_STATE)
+        res = auth._buildLoginURL(auth.clientId, None)
+        self.assertEqual(res, GITLAB_LOGIN_URL)
+
+    @async_to_deferred
+    async def test_buildBitbucketLoginURL(self) -> None:
+        auth = await self.setup_bitbucket_auth()
+
+        res = auth._buildLoginURL(auth.clientId, b'http://redir')
+        self.assertEqual(res, BITBUCKET_LOGIN_URL + REDIRECT_STATE)
+        res = auth._buildLoginURL(auth.clientId, None)
+        self.assertEqual(res, BITBUCKET_LOGIN_URL)
 
     @defer.inlineCallbacks
     def test_GoogleVerifyCode(self) -> InlineCallbacksType[None]:
         auth = yield self.setup_google_auth()
 
-        requests.get.side_effect = []
-        requests.post.side_effect = [FakeResponse({"access_token": 'TOK3N'})]
         auth.get = mock.Mock(
             side_effect=[{"name": 'foo bar', "email": 'bar@foo', "picture": 'http://pic'}]
         )
@@ -326,30 +321,14 @@ class OAuth2Auth(TestReactorMixin, www.WwwTestMixin, ConfigErrorsMixin, unittest
         auth = yield self.setup_github_auth()
 
         test = self
-        requests.get.side_effect = []
-        requests.post.side_effect = [FakeResponse({"access_token": 'TOK3N'})]
 
         def fake_get(self: Any, ep: str, **kwargs: Any) -> Any:
-            test.assertEqual(
-                self.headers,
-                {
-                    'Authorization': 'token TOK3N',
-                    'User-Agent': f'buildbot/{buildbot.version}',
-                },
-            )
+            test.assertEqual(self.headers, GITHUB_EXPECTED_HEADERS)
+            response = GITHUB_V3_RESPONSES.get(ep)
             if ep == '/user':
-                return {"login": 'bar', "name": 'foo bar', "email": 'buzz@bar'}
-            if ep == '/user/emails':
-                return [
-                    {'email': 'buzz@bar', 'verified': True, 'primary': False},
-                    {'email': 'bar@foo', 'verified': True, 'primary': True},
-                ]
-            if ep == '/user/orgs':
-                return [
-                    {"login": 'hello'},
-                    {"login": 'grp'},
-                ]
-            return None
+                # verifyCode() sets the email of the returned user in place
+                response = dict(response)
+            return response
 
         auth.get = fake_get
 
@@ -366,10 +345,8 @@ class OAuth2Auth(TestReactorMixin, www.WwwTestMixin, ConfigErrorsMixin, unittest
 
     @defer.inlineCallbacks
     def test_GithubVerifyCode_v4(self) -> InlineCallbacksType[None]:
-        auth = yield self.setup_github_auth_v4()
+        auth = yield self.setup_github_auth(apiVersion=4)
 
-        requests.get.side_effect = []
-        requests.post.side_effect = [FakeResponse({"access_token": 'TOK3N'})]
         auth.post = mock.Mock(
             side_effect=[
                 {
@@ -399,53 +376,9 @@ class OAuth2Auth(TestReactorMixin, www.WwwTestMixin, ConfigErrorsMixin, unittest
 
     @defer.inlineCallbacks
     def test_GithubVerifyCode_v4_teams(self) -> InlineCallbacksType[None]:
-        auth = yield self.setup_github_auth_v4_teams()
+        auth = yield self.setup_github_auth(apiVersion=4, getTeamsMembership=True)
 
-        requests.get.side_effect = []
-        requests.post.side_effect = [FakeResponse({"access_token": 'TOK3N'})]
-        auth.post = mock.Mock(
-            side_effect=[
-                {
-                    'data': {
-                        'viewer': {
-                            'organizations': {
-                                'edges': [{'node': {'login': 'hello'}}, {'node': {'login': 'grp'}}]
-                            },
-                            'login': 'bar',
-                            'email': 'bar@foo',
-                            'name': 'foo bar',
-                        }
-                    }
-                },
-                {
-                    'data': {
-                        'hello': {
-                            'teams': {
-                                'edges': [
-                                    {'node': {'name': 'developers', 'slug': 'develpers'}},
-                                    {'node': {'name': 'contributors', 'slug': 'contributors'}},
-                                ]
-                            }
-                        },
-                        'grp': {
-                            'teams': {
-                                'edges': [
-                                    {'node': {'name': 'developers', 'slug': 'develpers'}},
-                                    {'node': {'name': 'contributors', 'slug': 'contributors'}},
-                                    {'node': {'name': 'committers', 'slug': 'committers'}},
-                                    {
-                                        'node': {
-                                            'name': 'Team with spaces and caps',
-                                            'slug': 'team-with-spaces-and-caps',
-                                        }
-                                    },
-                                ]
-                            }
-                        },
-                    }
-                },
-            ]
-        )
+        auth.post = mock.Mock(side_effect=GITHUB_V4_TEAMS_RESPONSES)
         res = yield auth.verifyCode("code!")
         self.assertEqual(
             {
@@ -469,10 +402,14 @@ class OAuth2Auth(TestReactorMixin, www.WwwTestMixin, ConfigErrorsMixin, unittest
             res,
         )
 
-    def test_GitHubAuthBadApiVersion(self) -> None:
-        for bad_api_version in (2, 5, 'a'):
-            with self.assertRaisesConfigError('GitHubAuth apiVersion must be 3 or 4 not '):
-                oauth2.GitHubAuth("ghclientID", "clientSECRET", apiVersion=bad_api_version)  # type: ignore[arg-type]
+    @parameterized.expand([
+        ('v2', 2),
+        ('v5', 5),
+        ('not_a_number', 'a'),
+    ])
+    def test_GitHubAuthBadApiVersion(self, name: str, bad_api_version: Any) -> None:
+        with self.assertRaisesConfigError('GitHubAuth apiVersion must be 3 or 4 not '):
+            oauth2.GitHubAuth("ghclientID", "clientSECRET", apiVersion=bad_api_version)
 
     def test_GitHubAuthRaiseErrorWithApiV3AndGetTeamMembership(self) -> None:
         with self.assertRaisesConfigError(
@@ -485,8 +422,6 @@ class OAuth2Auth(TestReactorMixin, www.WwwTestMixin, ConfigErrorsMixin, unittest
     def test_GitlabVerifyCode(self) -> InlineCallbacksType[None]:
         auth = yield self.setup_gitlab_auth()
 
-        requests.get.side_effect = []
-        requests.post.side_effect = [FakeResponse({"access_token": 'TOK3N'})]
         auth.get = mock.Mock(
             side_effect=[
                 {  # /user
@@ -519,8 +454,6 @@ class OAuth2Auth(TestReactorMixin, www.WwwTestMixin, ConfigErrorsMixin, unittest
     def test_BitbucketVerifyCode(self) -> InlineCallbacksType[None]:
         auth = yield self.setup_bitbucket_auth()
 
-        requests.get.side_effect = []
-        requests.post.side_effect = [FakeResponse({"access_token": 'TOK3N'})]
         auth.get = mock.Mock(
             side_effect=[
                 {"username": 'bar', "display_name": 'foo bar'},  # /user
@@ -572,82 +505,59 @@ class OAuth2Auth(TestReactorMixin, www.WwwTestMixin, ConfigErrorsMixin, unittest
         res = yield self.render_resource(rsrc, b'/?token=token!')
         rsrc.auth.getLoginURL.assert_called_once()
 
-    @defer.inlineCallbacks
-    def test_getConfig_github(self) -> InlineCallbacksType[None]:
-        auth = yield self.setup_github_auth()
+    @async_to_deferred
+    async def test_getConfig_github(self) -> None:
+        auth = await self.setup_github_auth()
         self.assertEqual(
             auth.getConfigDict(),
             {'fa_icon': 'fa-github', 'autologin': False, 'name': 'GitHub', 'oauth2': True},
         )
 
-    @defer.inlineCallbacks
-    def test_getConfig_google(self) -> InlineCallbacksType[None]:
-        auth = yield self.setup_google_auth()
+    @async_to_deferred
+    async def test_getConfig_google(self) -> None:
+        auth = await self.setup_google_auth()
         self.assertEqual(
             auth.getConfigDict(),
             {'fa_icon': 'fa-google-plus', 'autologin': False, 'name': 'Google', 'oauth2': True},
         )
 
-    @defer.inlineCallbacks
-    def test_getConfig_gitlab(self) -> InlineCallbacksType[None]:
-        auth = yield self.setup_gitlab_auth()
+    @async_to_deferred
+    async def test_getConfig_gitlab(self) -> None:
+        auth = await self.setup_gitlab_auth()
         self.assertEqual(
             auth.getConfigDict(),
             {'fa_icon': 'fa-git', 'autologin': False, 'name': 'GitLab', 'oauth2': True},
         )
 
-    @defer.inlineCallbacks
-    def test_getConfig_bitbucket(self) -> InlineCallbacksType[None]:
-        auth = yield self.setup_bitbucket_auth()
+    @async_to_deferred
+    async def test_getConfig_bitbucket(self) -> None:
+        auth = await self.setup_bitbucket_auth()
         self.assertEqual(
             auth.getConfigDict(),
             {'fa_icon': 'fa-bitbucket', 'autologin': False, 'name': 'Bitbucket', 'oauth2': True},
         )
 
 
-class TestKeyCloakAuth(TestReactorMixin, www.WwwTestMixin, ConfigErrorsMixin, unittest.TestCase):
-    def setUp(self) -> None:
-        self.setup_test_reactor()
-        if requests is None:
-            raise unittest.SkipTest("Need to install requests to test oauth2")
-
-        self.patch(requests, 'request', mock.Mock(spec=requests.request))
-        self.patch(requests, 'post', mock.Mock(spec=requests.post))
-        self.patch(requests, 'get', mock.Mock(spec=requests.get))
-
-    @defer.inlineCallbacks
-    def setup_keycloak_auth(self) -> InlineCallbacksType[Any]:
-        auth = oauth2.KeyCloakAuth("instance_uri", "realm", "client_id", "client_secret")
-        master = yield self.make_master(url='http://localhost:5000/', auth=auth)
-        auth.reconfigAuth(master, master.config)
-        return auth
+class TestKeyCloakAuth(OAuth2TestMixin, unittest.TestCase):
+    def setup_keycloak_auth(self) -> defer.Deferred[Any]:
+        return self.setup_auth(
+            oauth2.KeyCloakAuth("instance_uri", "realm", "client_id", "client_secret"),
+            url='http://localhost:5000/',
+        )
 
-    @defer.inlineCallbacks
-    def test_get_key_cloak_verify_code(self) -> InlineCallbacksType[None]:
-        auth = yield self.setup_keycloak_auth()
+    @async_to_deferred
+    async def test_build_key_cloak_login_url(self) -> None:
+        auth = await self.setup_keycloak_auth()
 
-        res = yield auth.getLoginURL('http://redir')
-        exp = (
-            "instance_uri/realms/realm/protocol/openid-connect/auth?client_id=client_id&"
-            "redirect_uri=http%3A%2F%2Flocalhost%3A5000%2Fauth%2Flogin&response_type=code&"
-            "scope=openid&"
-            "state=redirect%3Dhttp%253A%252F%252Fredir"
-        )
-        self.assertEqual(res, exp)
-        res = yield auth.getLoginURL(None)
-        exp = (
-            "instance_uri/realms/realm/protocol/openid-connect/auth?client_id=client_id&"
-            "redirect_uri=http%3A%2F%2Flocalhost%3A5000%2Fauth%2Flogin&response_type=code&"
-            "scope=openid"
-        )
-        self.assertEqual(res, exp)
+        res = auth._buildLoginURL(auth.clientId, b'http://redir')
+        self.assertEqual(res, KEYCLOAK_LOGIN_URL + REDIRECT_STATE)
+        res = auth._buildLoginURL(auth.clientId, None)
+        self.assertEqual(res, KEYCLOAK_LOGIN_URL)
 
     @defer.inlineCallbacks
     def test_key_cloak_verify_code(self) -> InlineCallbacksType[None]:
         auth = yield self.setup_keycloak_auth()
 
-        requests.get.side_effect = []
-        requests.post.side_effect = [FakeResponse({"access_token": 'TOK3N'})]
         auth.get = mock.Mock(
             side_effect=[
                 {
@@ -701,6 +611,19 @@ class TestKeyCloakAuth(TestReactorMixin, www.WwwTestMixin, ConfigErrorsMixin, un
 #  }
 
 
+@contextlib.contextmanager
+def _ignore_insecure_requests() -> Iterator[None]:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", urllib3.exceptions.InsecureRequestWarning)
+        yield
+
+
+@functools.lru_cache(maxsize=1)
+def _load_oauth_conf(path: str) -> dict[str, Any]:
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
 class OAuth2AuthGitHubE2E(TestReactorMixin, www.WwwTestMixin, unittest.TestCase):
     authClass = "GitHubAuth"
     timeout = 60
@@ -721,11 +644,15 @@ class OAuth2AuthGitHubE2E(TestReactorMixin, www.WwwTestMixin, unittest.TestCase)
                 "Need to pass OAUTHCONF path to json file via environ to run this e2e test"
             )
 
-        with open(os.environ['OAUTHCONF'], encoding='utf-8') as f:
-            jsonData = f.read()
-        config = json.loads(jsonData).get(self.authClass, None)
+        config = _load_oauth_conf(os.environ['OAUTHCONF']).get(self.authClass, None)
         if config is None:
             raise unittest.SkipTest(f"{self.authClass} is not in OAUTHCONF file")
+        # the provider consent page needs a real user, so fail fast instead of
+        # waiting for the test timeout when no browser can be launched
+        try:
+            webbrowser.get()
+        except webbrowser.Error as e:
+            raise unittest.SkipTest("Need a web browser to run this e2e test") from e
         from buildbot.www import oauth2  # noqa: PLC0415
 
         self.auth = self._instantiateAuth(getattr(oauth2, self.authClass), config)
@@ -741,9 +668,9 @@ class OAuth2AuthGitHubE2E(TestReactorMixin, www.WwwTestMixin, unittest.TestCase)
         # browsers has the bad habit on not closing the persistent
         # connections, so we need to hack them away to make trial happy
         f = failure.Failure(Exception("test end"))
-        for reader in reactor.getReaders():  # type: ignore[attr-defined]
-            if isinstance(reader, Server):
-                reader.connectionLost(f)
+        servers = [r for r in reactor.getReaders() if type(r) is Server]  # type: ignore[attr-defined]
+        for server in servers:
+            server.connectionLost(f)
 
     @defer.inlineCallbacks
     def test_E2E(self) -> InlineCallbacksType[None]:
@@ -782,9 +709,7 @@ class OAuth2AuthGitHubE2E(TestReactorMixin, www.WwwTestMixin, unittest.TestCase)
                 webbrowser.open('http://localhost:5000/auth/login'), "Could not open web browser"
             )
 
-        with warnings.catch_warnings():
-            if not self.ssl_verify:
-                warnings.simplefilter("ignore", urllib3.exceptions.InsecureRequestWarning)
+        with contextlib.nullcontext() if self.ssl_verify else _ignore_insecure_requests():
             twistedDeferToThread(thd)
             res = yield d
         yield listener.stopListening()
@@ -134,6 +134,9 @@ class OAuth2Auth(auth.AuthBase):
         p = Properties()
         p.master = self.master
         clientId = yield p.render(self.clientId)
+        return self._buildLoginURL(clientId, redirect_url)
+
+    def _buildLoginURL(self, clientId: str, redirect_url: bytes | None) -> str:
         oauth_params = {
             'redirect_uri': self.loginUri,
             'client_id': clientId,
@@ -11,8 +11,14 @@
 # Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
 
+import hashlib
+import io
 import os
+import shutil
+import subprocess
 import sys
+import tempfile
+import time
 
 """
 Generates changelog information using git.
@@ -20,6 +26,14 @@ Generates changelog information using git.
 
 __docformat__ = 'restructuredtext'
 
+LOG_FORMAT = 'format:%ad  %ae%n  * %s'
+# one line per commit, without the author email
+TERSE_LOG_FORMAT = 'format:%h %ad %s'
+# the output is cached: keep user config such as log.date or
+# i18n.logOutputEncoding from changing how commits are printed
+LOG_OPTIONS = ('--date=default', '--encoding=UTF-8')
+COMMIT_GRAPH_MAX_AGE = 24 * 60 * 60
+
 
 def print_err(msg):
     """
@@ -36,8 +50,303 @@ def usage():
     """
     Prints out usage information to stderr.
     """
-    print_err(f'Usage: {sys.argv[0]} git-binary since')
+    print_err(f'Usage: {sys.argv[0]} git-binary since [limit]')
     print_err(f'Example: {sys.argv[0]} /usr/bin/git f5067523dfae9c7cdefc828721ec593ac7be62db')
+    print_err('Set CHANGELOG_TERSE=1 for one line per commit with its short hash')
+
+
+def resolve_revisions(git_bin, *revisions):
+    """
+    Resolves revisions to commit ids.
+
+    :Parameters:
+       - `git_bin`: path to the git binary.
+       - `revisions`: the revisions to resolve.
+
+    :Returns: list of commit ids, or None if any revision is unknown.
+    """
+    commit_ids = []
+    for revision in revisions:
+        proc = subprocess.run(
+            [git_bin, 'rev-parse', '--verify', '--quiet', revision + '^{commit}'],
+            check=False,
+            stdout=subprocess.PIPE,
+        )
+        if proc.returncode != 0:
+            return None
+        commit_ids.append(proc.stdout.decode('ascii').strip())
+    return commit_ids
+
+
+def get_cache_path(since_id, log_format):
+    """
+    Returns the path of the cached changelog starting from a commit.
+
+    The cache file holds the id of the last commit it covers on its first
+    line, followed by the output of git log.
+
+    :Parameters:
+       - `since_id`: commit id the changelog starts from (excluded).
+       - `log_format`: git log format of the changelog.
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    key = hashlib.sha1(' '.join([since_id, log_format, *LOG_OPTIONS]).encode()).hexdigest()
+    return os.path.join(cache_home, 'buildbot-changelog', key)
+
+
+def is_ancestor(git_bin, ancestor_id, commit_id):
+    """
+    Checks whether a commit is an ancestor of another one.
+
+    :Parameters:
+       - `git_bin`: path to the git binary.
+       - `ancestor_id`: the possible ancestor.
+       - `commit_id`: the commit to check against.
+    """
+    proc = subprocess.run(
+        [git_bin, 'merge-base', '--is-ancestor', ancestor_id, commit_id],
+        check=False,
+        stderr=subprocess.DEVNULL,
+    )
+    return proc.returncode == 0
+
+
+def has_merges(git_bin, revisions):
+    """
+    Checks whether any of the commits selected by revisions is a merge.
+
+    :Parameters:
+       - `git_bin`: path to the git binary.
+       - `revisions`: revisions to list, as given to git rev-list.
+    """
+    proc = subprocess.run(
+        [git_bin, 'rev-list', '--min-parents=2', '--max-count=1', *revisions],
+        check=False,
+        stdout=subprocess.PIPE,
+    )
+    # assume the worst if git can not tell
+    return proc.returncode != 0 or bool(proc.stdout.strip())
+
+
+def copy_to(src, outputs):
+    """
+    Copies a binary file to several outputs, passing data on as soon as it
+    is available rather than once a full chunk has been read.
+
+    :Parameters:
+       - `src`: binary file to read from.
+       - `outputs`: binary files to write to.
+    """
+    stdout = sys.stdout.buffer
+    for chunk in iter(lambda: src.read1(65536), b''):
+        for output in outputs:
+            output.write(chunk)
+        # show each commit as soon as git produces it, even through a pipe
+        if stdout in outputs:
+            stdout.flush()
+
+
+def send_file(src, outputs):
+    """
+    Copies the rest of a binary file to several outputs, letting the kernel
+    do the copy where os.sendfile supports it.
+
+    :Parameters:
+       - `src`: binary file to read from.
+       - `outputs`: binary files to write to.
+    """
+    start = src.tell()
+    has_sendfile = hasattr(os, 'sendfile')
+    for output in outputs:
+        output.flush()
+        offset = start
+        if has_sendfile:
+            try:
+                while sent := os.sendfile(output.fileno(), src.fileno(), offset, 1 << 20):
+                    offset += sent
+            except (OSError, io.UnsupportedOperation):
+                # no sendfile for this kind of output
+                pass
+            else:
+                continue
+        src.seek(offset)
+        copy_to(src, [output])
+
+
+def refresh_commit_graph(git_bin):
+    """
+    Writes the commit-graph file in the background, at most once a day.
+
+    git log walks history much faster when a commit-graph is available, so
+    the next runs get faster even if this one does not.
+
+    :Parameters:
+       - `git_bin`: path to the git binary.
+    """
+    proc = subprocess.run(
+        [
+            git_bin,
+            'rev-parse',
+            '--is-shallow-repository',
+            '--git-path',
+            'buildbot-changelog-commit-graph',
+        ],
+        check=False,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    if proc.returncode != 0:
+        return
+    is_shallow, stamp = proc.stdout.decode().splitlines()
+    # git writes no commit-graph for a shallow clone
+    if is_shallow == 'true':
+        return
+    # Rate limit on a stamp of the last attempt rather than on the
+    # commit-graph itself, which is not written if git fails
+    try:
+        if time.time() - os.stat(stamp).st_mtime < COMMIT_GRAPH_MAX_AGE:
+            return
+    except OSError:
+        pass
+    try:
+        with open(stamp, 'a'):
+            os.utime(stamp)
+    except OSError:
+        return
+    # The process is not waited for on purpose: it finishes on its own after
+    # this script exits, out of reach of terminal signals such as ^C. With
+    # warnings enabled, Python reports it as "still running" at exit.
+    subprocess.Popen(
+        [git_bin, 'commit-graph', 'write', '--reachable', '--changed-paths'],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def start_log(git_bin, log_format, revisions, *extra_args):
+    """
+    Starts git log on some revisions with its output piped.
+
+    :Parameters:
+       - `git_bin`: path to the git binary.
+       - `log_format`: git log format of each commit.
+       - `revisions`: revisions to log, as given to git log.
+       - `extra_args`: additional git log arguments.
+
+    :Returns: the git process.
+    """
+    refresh_commit_graph(git_bin)
+    return subprocess.Popen(
+        # no diff is shown, make sure git does not compute one
+        [
+            git_bin,
+            'log',
+            '-s',
+            '--no-renames',
+            '--pretty=' + log_format,
+            *LOG_OPTIONS,
+            *extra_args,
+            *revisions,
+        ],
+        stdout=subprocess.PIPE,
+        # git block-buffers its output to a pipe, have it flush every commit
+        env={**os.environ, 'GIT_FLUSH': '1'},
+    )
+
+
+def stream_log(git_bin, log_format, revisions, outputs):
+    """
+    Runs git log on some revisions and copies its output as it comes.
+
+    :Parameters:
+       - `git_bin`: path to the git binary.
+       - `log_format`: git log format of each commit.
+       - `revisions`: revisions to log, as given to git log.
+       - `outputs`: binary files the log is written to.
+
+    :Returns: the exit status of git.
+    """
+    # the pipe is closed and git waited for even if writing fails
+    with start_log(git_bin, log_format, revisions) as proc:
+        copy_to(proc.stdout, outputs)
+    return proc.returncode
+
+
+def stream_limited_log(git_bin, log_format, revisions, limit):
+    """
+    Runs git log on some revisions and prints at most `limit` commits,
+    followed by a marker if more commits were left out.
+
+    :Parameters:
+       - `git_bin`: path to the git binary.
+       - `log_format`: git log format of each commit.
+       - `revisions`: revisions to log, as given to git log.
+       - `limit`: maximum number of commits to print.
+
+    :Returns: the exit status of git.
+    """
+    stdout = sys.stdout.buffer
+    # ask for one more commit than printed, to know whether to truncate
+    max_lines = limit * (log_format.count('%n') + 1)
+    truncated = False
+    with start_log(git_bin, log_format, revisions, f'--max-count={limit + 1}') as proc:
+        for line_count, line in enumerate(proc.stdout):
+            if line_count < max_lines:
+                stdout.write(line)
+                stdout.flush()
+            else:
+                truncated = True
+    if truncated:
+        stdout.write(b'  * ... (truncated; rerun with a larger limit)')
+    stdout.write(b'\n')
+    return proc.returncode
+
+
+def write_changelog(git_bin, log_format, head_id, exclude_ids, *, cached_log, cache_path):
+    """
+    Writes the changelog to stdout and updates the cache with it.
+
+    :Parameters:
+       - `git_bin`: path to the git binary.
+       - `log_format`: git log format of each commit.
+       - `head_id`: commit id to end the git log at.
+       - `exclude_ids`: commit ids whose history is left out of the git log.
+       - `cached_log`: binary file with the cached log of the commits that
+         git log leaves out, or None.
+       - `cache_path`: path of the cache file to update.
+
+    :Returns: the exit status of git.
+    """
+    stdout = sys.stdout.buffer
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp = tempfile.NamedTemporaryFile(dir=os.path.dirname(cache_path), delete=False)
+        tmp.write(head_id.encode('ascii') + b'\n')
+        outputs = [stdout, tmp]
+    except OSError:
+        tmp = None
+        outputs = [stdout]
+
+    rc = None
+    try:
+        revisions = [head_id] + ['^' + commit_id for commit_id in exclude_ids]
+        rc = stream_log(git_bin, log_format, revisions, outputs)
+        if cached_log and rc == 0:
+            # git log output has no trailing newline: separate the new commits
+            # from the cached ones
+            for output in outputs:
+                output.write(b'\n')
+            send_file(cached_log, outputs)
+        stdout.write(b'\n')
+    finally:
+        if tmp:
+            tmp.close()
+            if rc == 0:
+                os.replace(tmp.name, cache_path)
+            else:
+                os.unlink(tmp.name)
+    return rc
 
 
 def main(args):
@@ -51,20 +360,84 @@ def main(args):
     try:
         git_bin = args[0]
         since = args[1]
-    except IndexError:
+        limit = int(args[2]) if len(args) > 2 else None
+    except (IndexError, ValueError):
+        usage()
+        return 1
+    if limit is not None and limit < 1:
         usage()
         return 1
 
-    if not os.access(git_bin, os.X_OK):
+    log_format = TERSE_LOG_FORMAT if os.environ.get('CHANGELOG_TERSE') == '1' else LOG_FORMAT
+
+    # Accept a bare command name as well as a path, as a shell would
+    resolved_git_bin = shutil.which(git_bin)
+    if resolved_git_bin is None:
         print_err(f'Can not access {git_bin}')
         return 1
+    git_bin = resolved_git_bin
 
-    # Open a pipe and force the format
-    pipe = os.popen(git_bin + ' log --pretty="format:%ad  %ae%n  * %s" ' + since + '..')
-    print(pipe.read())
-    pipe.close()
-    return 0
+    # Check the revisions up front instead of failing after a full history walk
+    commit_ids = resolve_revisions(git_bin, since, 'HEAD')
+    if commit_ids is None:
+        print_err(f'Can not resolve {since}')
+        return 1
+    since_id, head_id = commit_ids
+
+    if limit is not None:
+        rc = stream_limited_log(git_bin, log_format, [head_id, '^' + since_id], limit)
+        if rc != 0:
+            print_err(f'git log exited with status {rc}')
+        return rc
+
+    # The log of a range of commits never changes: reuse the output of a
+    # previous run, and only ask git for the commits added on top of it
+    cache_path = get_cache_path(since_id, log_format)
+    try:
+        cache = open(cache_path, 'rb')
+    except OSError:
+        rc = write_changelog(
+            git_bin, log_format, head_id, [since_id], cached_log=None, cache_path=cache_path
+        )
+    else:
+        with cache:
+            cached_head_id = cache.readline().decode('ascii').strip()
+            if cached_head_id == head_id:
+                send_file(cache, [sys.stdout.buffer])
+                sys.stdout.buffer.write(b'\n')
+                rc = 0
+            elif (
+                # only a linear run of commits on top of the cached head is
+                # logged by git before all of the cached commits, in the same
+                # order as a full walk; anything else is regenerated in full
+                is_ancestor(git_bin, since_id, cached_head_id)
+                and is_ancestor(git_bin, cached_head_id, head_id)
+                and not has_merges(git_bin, [head_id, '^' + since_id, '^' + cached_head_id])
+            ):
+                cached_log = cache if cache.peek(1) else None
+                rc = write_changelog(
+                    git_bin,
+                    log_format,
+                    head_id,
+                    [since_id, cached_head_id],
+                    cached_log=cached_log,
+                    cache_path=cache_path,
+                )
+            else:
+                rc = write_changelog(
+                    git_bin, log_format, head_id, [since_id], cached_log=None, cache_path=cache_path
+                )
+
+    if rc != 0:
+        print_err(f'git log exited with status {rc}')
+    return rc
 
 
 if __name__ == '__main__':
-    raise SystemExit(main(sys.argv[1:]))
+    try:
+        raise SystemExit(main(sys.argv[1:]))
+    except BrokenPipeError:
+        # the reader went away, e.g. `| head`: stop quietly, and keep the
+        # interpreter from failing again when flushing stdout at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        raise SystemExit(1) from None